@@ -1,7 +1,7 @@
 """
 Notion Research Buddy - MCP Server + HTTP API
 ==============================================
-A stateful refinement agent that connects Notion, LangGraph, and Gemini.
+A refinement agent that connects Notion and Gemini.
 
 Usage:
     python server.py          # Run as MCP server (default)
@@ -9,15 +9,27 @@ Usage:
 """
 
 import os
+import re
 import sys
+import asyncio
+import json
+import hashlib
+import time
 import logging
-from typing import Optional, Dict, Any
+from collections import deque
+from datetime import datetime
+from functools import cache, partial
+from typing import Optional, Dict, Any, Union, AsyncIterator
+import httpx
+import orjson
+from diskcache import Cache
 from dotenv import load_dotenv
 from fastmcp import FastMCP
-from pydantic import BaseModel, Field
-from notion_client import Client
+from pydantic import BaseModel, Field, ValidationError, field_validator
+from notion_client import AsyncClient
+from langchain_core.messages import BaseMessage
+from langchain_core.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI
-from langgraph.graph import StateGraph, END
 
 # Load environment variables
 load_dotenv()
@@ -37,21 +49,282 @@ if not NOTION_API_KEY:
 if not GEMINI_API_KEY:
     logger.warning("GEMINI_API_KEY not set. LLM operations will fail.")
 
-notion = Client(auth=NOTION_API_KEY)
+# On-disk caches live next to server.py unless CACHE_DIR says otherwise;
+# MCP hosts usually start the server from an unrelated working directory
+CACHE_DIR = os.environ.get("CACHE_DIR", os.path.dirname(os.path.abspath(__file__)))
+
+# Long-lived pooled HTTP/2 clients: connections (and their TLS sessions) are
+# reused across calls, and concurrent requests to the same host multiplex
+# over one connection. Notion and Gemini each get their own client because
+# notion_client rewrites base_url/headers on the client it is given.
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+notion_http = httpx.AsyncClient(http2=True, limits=HTTP_LIMITS)
+llm_http = httpx.AsyncClient(http2=True, limits=HTTP_LIMITS)
+
+
+async def close_http_clients() -> None:
+    """Close the shared HTTP clients (call on shutdown)."""
+    await notion_http.aclose()
+    await llm_http.aclose()
+
+
+class OrjsonAsyncClient(AsyncClient):
+    """Notion client that serializes JSON request bodies with orjson instead of stdlib json."""
+
+    def _build_request(self, method, path, query=None, body=None, form_data=None, auth=None) -> httpx.Request:
+        if body is None or form_data:
+            # Body-less requests and multipart uploads are built unchanged
+            return super()._build_request(method, path, query, body, form_data, auth)
+
+        # Build without a body, then rebuild with the orjson payload so the
+        # request's content, headers and stream all agree
+        request = super()._build_request(method, path, query, None, None, auth)
+        headers = request.headers.copy()
+        headers.pop("Content-Length", None)
+        headers["Content-Type"] = "application/json"
+        return httpx.Request(
+            method,
+            request.url,
+            headers=headers,
+            content=orjson.dumps(body),
+            extensions=request.extensions,
+        )
+
+
+notion = OrjsonAsyncClient(auth=NOTION_API_KEY, client=notion_http)
 mcp = FastMCP("Notion Research Buddy")
 
+# Notion API limits: children per blocks.children.append request,
+# characters per rich_text object, and rich_text objects per block
+NOTION_MAX_CHILDREN = 100
+NOTION_MAX_TEXT_LENGTH = 2000
+NOTION_MAX_RICH_TEXT = 100
+
+# Cap on in-flight Notion requests (~3 req/s average rate limit, bursts allowed)
+NOTION_CONCURRENCY = 8
+notion_semaphore = asyncio.Semaphore(NOTION_CONCURRENCY)
+
+# Blocks whose children are separate pages/databases, not content of this page
+NOTION_SKIP_CHILDREN = {"child_page", "child_database"}
+
+# Results keyed by page and its `last_edited_time`: a page that has not
+# changed since it was last read/processed is served without listing blocks
+# or calling the LLM. Notion reports last_edited_time to the minute, so an
+# entry is only trusted when it was stored in a later minute than that
+# timestamp; an edit in the same minute as the cached run would be invisible.
+PAGE_CACHE_TTL = 24 * 60 * 60  # seconds
+page_cache = Cache(os.path.join(CACHE_DIR, ".page_cache"))
+
+
+def chunk_list(items: list, size: int) -> list[list]:
+    """Split a list into consecutive chunks of at most `size` items."""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def chunk_text(text: str, size: int = NOTION_MAX_TEXT_LENGTH) -> list[str]:
+    """Split text into consecutive chunks of at most `size` characters."""
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def rich_text(text: str) -> list[Dict[str, Any]]:
+    """Build Notion rich_text objects for text of any length."""
+    return [{"type": "text", "text": {"content": chunk}} for chunk in chunk_text(text)]
+
+
+def heading_block(text: str) -> Dict[str, Any]:
+    return {
+        "object": "block",
+        "type": "heading_2",
+        "heading_2": {
+            "rich_text": [{"type": "text", "text": {"content": text}}]
+        }
+    }
+
+
+def refined_notes_blocks(refined_content: str) -> list[Dict[str, Any]]:
+    """Divider, heading and the refined notes as one or more paragraphs."""
+    blocks = [
+        {
+            "object": "block",
+            "type": "divider",
+            "divider": {}
+        },
+        heading_block("✨ Refined Notes"),
+    ]
+    # Split across rich_text objects (and paragraphs if needed) so nothing
+    # is lost to Notion's per-object length limit
+    for text_batch in chunk_list(rich_text(refined_content), NOTION_MAX_RICH_TEXT):
+        blocks.append({
+            "object": "block",
+            "type": "paragraph",
+            "paragraph": {
+                "rich_text": text_batch
+            }
+        })
+    return blocks
+
+
+async def append_blocks(page_id: str, children: list[Dict[str, Any]]) -> None:
+    """Append blocks to a page, one round-trip per 100 children."""
+    for batch in chunk_list(children, NOTION_MAX_CHILDREN):
+        await notion.blocks.children.append(page_id, children=batch)
+
+
+def diagram_blocks(mermaid_code: str) -> list[Dict[str, Any]]:
+    """Heading and the Mermaid diagram as a code block."""
+    blocks = [heading_block("📊 Architecture Diagram")]
+    if mermaid_code:
+        blocks.append({
+            "object": "block",
+            "type": "code",
+            "code": {
+                "rich_text": rich_text(mermaid_code)[:NOTION_MAX_RICH_TEXT],
+                "language": "mermaid"
+            }
+        })
+    return blocks
+
+
+async def _list_children(**kwargs: Any) -> Dict[str, Any]:
+    async with notion_semaphore:
+        return await notion.blocks.children.list(**kwargs)
+
+
+async def iter_blocks(block_id: str) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Yield every block under `block_id` in document order.
+
+    Follows `has_more`/`next_cursor` pagination, prefetching the next page
+    while the current one is consumed, and recurses into nested children
+    (toggles, columns, ...). Top-level results are streamed page by page,
+    but the subtrees of every block with children on the current page are
+    fetched concurrently and each is held in memory as a full list until
+    it is yielded.
+    """
+    pending = asyncio.ensure_future(_list_children(block_id=block_id, page_size=NOTION_MAX_CHILDREN))
+    subtrees: Dict[str, asyncio.Future] = {}
+    try:
+        while pending is not None:
+            response = await pending
+            pending = None
+            if response.get("has_more"):
+                pending = asyncio.ensure_future(_list_children(
+                    block_id=block_id,
+                    page_size=NOTION_MAX_CHILDREN,
+                    start_cursor=response["next_cursor"],
+                ))
+
+            results = response["results"]
+            subtrees = {
+                block["id"]: asyncio.ensure_future(collect_blocks(block["id"]))
+                for block in results
+                if block.get("has_children") and block["type"] not in NOTION_SKIP_CHILDREN
+            }
+            for block in results:
+                yield block
+                if block["id"] in subtrees:
+                    for child in await subtrees.pop(block["id"]):
+                        yield child
+    finally:
+        # Consumer stopped early (or a fetch failed): drop outstanding requests
+        for task in [pending, *subtrees.values()]:
+            if task is not None:
+                task.cancel()
+
+
+async def collect_blocks(block_id: str) -> list[Dict[str, Any]]:
+    """Fetch every block under `block_id` into a list, in document order."""
+    return [block async for block in iter_blocks(block_id)]
+
+
+async def page_last_edited(page_id: str) -> str:
+    """Fetch only the page's `last_edited_time` (much cheaper than listing blocks)."""
+    async with notion_semaphore:
+        page = await notion.pages.retrieve(page_id=page_id)
+    return page["last_edited_time"]
+
+
+def _epoch_minute(timestamp: float) -> int:
+    return int(timestamp // 60)
+
+
+def cached_page_result(kind: str, page_id: str, last_edited: str) -> Optional[str]:
+    """Return the cached `kind` result for the page if it is still current."""
+    cached = page_cache.get((kind, page_id))
+    if not cached or len(cached) != 3 or cached[0] != last_edited:
+        return None
+    edited_at = datetime.fromisoformat(last_edited.replace("Z", "+00:00")).timestamp()
+    if _epoch_minute(cached[1]) <= _epoch_minute(edited_at):
+        return None
+    logger.info(f"⏭️ Page unchanged since last {kind}, using cached result")
+    return cached[2]
+
+
+def store_page_result(kind: str, page_id: str, last_edited: str, result: str) -> None:
+    """Cache `result` for the page, stamped with the time of this run."""
+    page_cache.set((kind, page_id), (last_edited, time.time(), result), expire=PAGE_CACHE_TTL)
+
+
+def _paragraph_text(block: Dict[str, Any]) -> str:
+    return "\n".join(t["plain_text"] for t in block["paragraph"]["rich_text"])
+
+
+def _heading_text(level: int, block: Dict[str, Any]) -> str:
+    items = block[f"heading_{level}"]["rich_text"]
+    if not items:
+        return ""
+    return f"\n{'#' * level} {''.join(t['plain_text'] for t in items)}\n"
+
+
+def _bullet_text(block: Dict[str, Any]) -> str:
+    return "\n".join(f"• {t['plain_text']}" for t in block["bulleted_list_item"]["rich_text"])
+
+
+def _skip_block(block: Dict[str, Any]) -> str:
+    return ""
+
+
+# Block type -> text extractor; unknown block types are skipped
+BLOCK_TEXT_HANDLERS = {
+    "paragraph": _paragraph_text,
+    "heading_1": partial(_heading_text, 1),
+    "heading_2": partial(_heading_text, 2),
+    "heading_3": partial(_heading_text, 3),
+    "bulleted_list_item": _bullet_text,
+}
+PARAGRAPH_TEXT_HANDLERS = {"paragraph": _paragraph_text}
+
+
+async def iter_text(block_id: str, handlers: Dict[str, Any] = BLOCK_TEXT_HANDLERS) -> AsyncIterator[str]:
+    """Yield the non-empty text fragment of each block that has a handler, as blocks arrive."""
+    async for block in iter_blocks(block_id):
+        text = handlers.get(block["type"], _skip_block)(block)
+        if text:
+            yield text
+
+
+async def read_text(block_id: str, handlers: Dict[str, Any] = BLOCK_TEXT_HANDLERS) -> str:
+    """Read the text under `block_id`, one line per fragment."""
+    return "\n".join([text async for text in iter_text(block_id, handlers)])
+
+
 # --- 2. Data Models (Strict Mode) ---
-class AgentState(BaseModel):
-    """The shared memory of the agent as it thinks."""
-    raw_notes: str = Field(..., description="Raw text from Notion")
-    refined_notes: Optional[str] = Field(None, description="Cleaned markdown")
-    mermaid_code: Optional[str] = Field(None, description="Mermaid diagram code")
-    page_id: str
+# Notion page IDs: 32 hex characters, optionally in dashed UUID form
+_PAGE_ID_RE = re.compile(r"^[0-9a-f]{32}$")
 
 
 class PageContext(BaseModel):
     """Input model for MCP tools."""
-    page_id: str = Field(..., description="Notion Page ID (32 characters, no dashes)")
+    page_id: str = Field(..., description="Notion Page ID (32 characters, dashes optional)")
+
+    @field_validator("page_id")
+    @classmethod
+    def _check_page_id(cls, v: str) -> str:
+        """Reject malformed IDs before any Notion call; normalize to dashless lowercase."""
+        v = v.strip().replace("-", "").lower()
+        if not _PAGE_ID_RE.match(v):
+            raise ValueError("page_id must be 32 hex characters (dashes optional)")
+        return v
 
 
 class DiagramInput(BaseModel):
@@ -66,62 +339,360 @@ class CombineDiagramsContext(BaseModel):
     title: str = Field(default="Unified Architecture", description="Title for the combined diagram")
 
 
-# --- 3. The Brain (LangGraph) ---
-# We use Gemini 2.0 Flash via the OpenAI Adapter for LangChain compatibility
-llm = ChatOpenAI(
-    api_key=GEMINI_API_KEY,
-    base_url="https://generativelanguage.googleapis.com/v1beta/openai/",
-    model="gemini-2.0-flash",
-    temperature=0.2
-)
+# Response models for the HTTP API; declaring them as return types lets
+# FastAPI serialize responses directly through Pydantic
+class StatusResponse(BaseModel):
+    status: str
+    message: str
 
 
-def rewrite_notes_node(state: AgentState) -> Dict[str, Any]:
-    """Node 1: Refine raw notes into clean markdown."""
-    logger.info("🧠 Refiner: Cleaning notes...")
-    prompt = f"""
-    Refine these raw notes into clean, structured Markdown.
-    Use headers, bullets, and bold text. Keep all information.
-    
-    Raw Notes:
-    {state.raw_notes}
+class PageContentResponse(BaseModel):
+    page_id: str
+    content: str
+
+
+class ProcessResponse(BaseModel):
+    page_id: str
+    result: str
+
+
+class CombineResponse(BaseModel):
+    title: str
+    combined_diagram: str
+
+
+# --- 3. The Brain ---
+# Sampling temperature per task: merging diagrams runs fully deterministic
+REFINE_TEMPERATURE = 0.2
+DIAGRAM_TEMPERATURE = 0.2
+COMBINE_TEMPERATURE = 0.0
+
+
+@cache
+def get_llm(temperature: float) -> ChatOpenAI:
     """
-    response = llm.invoke(prompt)
-    return {"refined_notes": response.content}
+    Chat model for the given temperature, built on first use.
 
+    We use Gemini 2.0 Flash via the OpenAI Adapter for LangChain compatibility.
+    """
+    return ChatOpenAI(
+        api_key=GEMINI_API_KEY,
+        base_url="https://generativelanguage.googleapis.com/v1beta/openai/",
+        model="gemini-2.0-flash",
+        temperature=temperature,
+        http_async_client=llm_http
+    )
 
-def generate_diagram_node(state: AgentState) -> Dict[str, Any]:
-    """Node 2: Generate a Mermaid diagram from the content."""
-    logger.info("🏗️ Architect: Generating diagram...")
-    content = state.refined_notes or state.raw_notes
-    prompt = f"""
-    Analyze this text and generate a Mermaid.js diagram (graph TD or sequenceDiagram)
-    that represents the system architecture or flow.
-    Return ONLY the Mermaid code, no markdown code blocks.
-    
-    Text:
-    {content}
+
+# Exact-match response cache: at low temperature the same prompt gives
+# effectively the same answer, so re-runs and identical pages skip the LLM.
+LLM_CACHE_TTL = 24 * 60 * 60  # seconds
+llm_cache = Cache(os.path.join(CACHE_DIR, ".llm_cache"))
+
+
+def llm_cache_key(chat: ChatOpenAI, prompt: Union[str, list[BaseMessage]]) -> str:
+    """Content-addressable key over (model, temperature, prompt)."""
+    if not isinstance(prompt, str):
+        prompt = [[message.type, message.content] for message in prompt]
+    payload = json.dumps(
+        {"model": chat.model_name, "temperature": chat.temperature, "prompt": prompt},
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SemanticCache:
+    """
+    Similarity cache for combined-diagram results.
+
+    Each diagram is embedded on its own, and an entry matches when it has
+    the same title and diagram count and every diagram clears the cosine
+    similarity threshold against its counterpart (diagrams are sorted by
+    label first, so counterparts line up). A diagram longer than the
+    encoder's max_seq_length is never embedded: the encoder would truncate
+    it, and two diagrams that only share a prefix would look identical.
+    Entries expire after `ttl` seconds; beyond `max_entries` the oldest go.
     """
-    response = llm.invoke(prompt)
+
+    def __init__(self, threshold: float, max_entries: int, ttl: int):
+        self.threshold = threshold
+        self.ttl = ttl
+        self._encoder = None
+        self._entries: deque = deque(maxlen=max_entries)
+
+    def _encode(self, texts: list[str]):
+        if self._encoder is None:
+            self._encoder = SentenceTransformer(SEMANTIC_CACHE_MODEL)
+        for text in texts:
+            if len(self._encoder.tokenizer(text)["input_ids"]) > self._encoder.max_seq_length:
+                return None
+        return self._encoder.encode(texts, normalize_embeddings=True)
+
+    async def embed(self, texts: list[str]):
+        """Embed each text, or return None if any is too long to embed faithfully."""
+        return await asyncio.to_thread(self._encode, texts)
+
+    def search(self, namespace: str, embeddings) -> Optional[str]:
+        """Return the best live entry whose every diagram clears the threshold."""
+        now = time.time()
+        best_score, best_response = self.threshold, None
+        for entry_namespace, cached, response, expires_at in self._entries:
+            if entry_namespace != namespace or expires_at < now or cached.shape != embeddings.shape:
+                continue
+            # Embeddings are normalized, so row-wise dot products are cosine similarities
+            score = float((cached * embeddings).sum(axis=1).min())
+            if score >= best_score:
+                best_score, best_response = score, response
+        return best_response
+
+    def add(self, namespace: str, embeddings, response: str) -> None:
+        now = time.time()
+        while self._entries and self._entries[0][3] < now:
+            self._entries.popleft()
+        self._entries.append((namespace, embeddings, response, now + self.ttl))
+
+
+# Semantic cache (opt-in): catches near-duplicate diagram sets that the
+# exact-match cache misses. Requires sentence-transformers.
+SEMANTIC_CACHE_MODEL = "all-MiniLM-L6-v2"
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", "1000"))
+semantic_cache: Optional[SemanticCache] = None
+
+if os.environ.get("SEMANTIC_CACHE") == "1":
+    try:
+        from sentence_transformers import SentenceTransformer
+        semantic_cache = SemanticCache(SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_MAX_ENTRIES, LLM_CACHE_TTL)
+    except ImportError:
+        logger.warning("SEMANTIC_CACHE=1 but sentence-transformers is not installed. Semantic cache disabled.")
+
+
+async def cached_ainvoke(chat: ChatOpenAI, prompt: Union[str, list[BaseMessage]]) -> str:
+    """Invoke the model, serving repeated prompts from the response cache."""
+    key = llm_cache_key(chat, prompt)
+    cached = llm_cache.get(key)
+    if cached is not None:
+        logger.info("💾 LLM cache hit")
+        return cached
+
+    response = await chat.ainvoke(prompt)
+    content = response.content
+
+    if content:
+        llm_cache.set(key, content, expire=LLM_CACHE_TTL)
+    return content
+
+
+# Markdown code fence tokens (``` or ```mermaid) the model may wrap its output in,
+# wherever they appear (own line, same line as the code, CRLF endings)
+_FENCE_RE = re.compile(r"```(?:mermaid)?")
+
+
+def strip_code_fences(text: str) -> str:
+    """Remove markdown code fences in a single pass."""
+    return _FENCE_RE.sub("", text).strip()
+
+
+# Prompt templates are built once at import. Static task instructions are
+# the system message; the per-call data (page text, diagrams) is the human message.
+REFINE_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", """
+Refine the raw notes you are given into clean, structured Markdown.
+Use headers, bullets, and bold text. Keep all information.
+"""),
+    ("human", "Raw Notes:\n{raw_notes}"),
+])
+
+DIAGRAM_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", """
+Analyze the text you are given and generate a Mermaid.js diagram (graph TD or sequenceDiagram)
+that represents the system architecture or flow.
+Return ONLY the Mermaid code, no markdown code blocks.
+"""),
+    ("human", "Text:\n{content}"),
+])
+
+COMBINE_INSTRUCTIONS = """
+You are an expert at creating Mermaid.js architecture diagrams.
+You will be given several separate architecture diagrams to combine
+into ONE unified system architecture diagram.
+
+Requirements:
+1. Create a single cohesive graph TD diagram
+2. Group each original diagram as a named subgraph
+3. Identify logical connections BETWEEN the different systems
+4. Use consistent styling and clear node names
+5. Add a main title subgraph wrapping everything
+6. Keep node labels concise but descriptive
+7. Return ONLY the Mermaid code, no markdown blocks or explanations
+"""
+
+COMBINE_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", COMBINE_INSTRUCTIONS),
+    ("human", """
+I have {count} separate architecture diagrams that I need you to combine
+into ONE unified system architecture diagram titled "{title}".
+
+Here are the diagrams to combine:
+
+{diagrams}
+
+Generate the combined Mermaid diagram:
+"""),
+])
+
+# Several combine requests answered in one call; each answer is preceded by
+# a `=== RESULT <n> ===` marker line so the response can be split back up
+COMBINE_BATCH_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", COMBINE_INSTRUCTIONS + """
+You will receive several independent requests, each starting with a
+`=== REQUEST <n> ===` line. Answer every request separately and in order.
+Start each answer with a line `=== RESULT <n> ===` using the same <n>.
+Apart from these marker lines, each answer follows the requirements above.
+"""),
+    ("human", "{requests}"),
+])
+
+COMBINE_BATCH_SECTION = """=== REQUEST {index} ===
+Combine these {count} architecture diagrams into ONE unified system architecture diagram titled "{title}":
+
+{diagrams}
+"""
+
+_RESULT_MARKER_RE = re.compile(r"^=== RESULT (\d+) ===[ \t]*$", re.MULTILINE)
+
+
+async def refine_notes(raw_notes: str) -> str:
+    """Refiner: Refine raw notes into clean markdown."""
+    logger.info("🧠 Refiner: Cleaning notes...")
+    messages = REFINE_PROMPT.format_messages(raw_notes=raw_notes)
+    return await cached_ainvoke(get_llm(REFINE_TEMPERATURE), messages)
+
+
+async def generate_diagram(raw_notes: str) -> str:
+    """Architect: Generate a Mermaid diagram from the raw notes (runs alongside the refiner)."""
+    logger.info("🏗️ Architect: Generating diagram...")
+    messages = DIAGRAM_PROMPT.format_messages(content=raw_notes)
+    content = await cached_ainvoke(get_llm(DIAGRAM_TEMPERATURE), messages)
     # Clean up markdown code blocks if present
-    code = response.content.replace("```mermaid", "").replace("```", "").strip()
-    return {"mermaid_code": code}
+    return strip_code_fences(content)
+
+
+def combine_cache_key(count: int, title: str, diagrams_text: str) -> str:
+    """Exact-match cache key of the single-request combine prompt."""
+    messages = COMBINE_PROMPT.format_messages(count=count, title=title, diagrams=diagrams_text)
+    return llm_cache_key(get_llm(COMBINE_TEMPERATURE), messages)
+
 
+async def combine_with_llm(count: int, title: str, diagrams_text: str) -> str:
+    """Merge one set of diagrams with a single LLM call."""
+    messages = COMBINE_PROMPT.format_messages(count=count, title=title, diagrams=diagrams_text)
+    return strip_code_fences(await cached_ainvoke(get_llm(COMBINE_TEMPERATURE), messages))
 
-# Define the Workflow
-workflow = StateGraph(AgentState)
-workflow.add_node("refiner", rewrite_notes_node)
-workflow.add_node("architect", generate_diagram_node)
-workflow.set_entry_point("refiner")
-workflow.add_edge("refiner", "architect")
-workflow.add_edge("architect", END)
-app = workflow.compile()
+
+class CombineBatcher:
+    """
+    Micro-batcher for combine requests.
+
+    Requests arriving within `window` seconds of each other (up to
+    `max_size`) are sent to the LLM as one prompt with numbered sections,
+    amortizing the fixed instructions across callers. Requests already in
+    the exact-match cache never join a batch, and each split answer is
+    cached under its own single-request key. If the response cannot be
+    split back into one answer per request, each request falls back to
+    its own call.
+    """
+
+    def __init__(self, window: float, max_size: int):
+        self.window = window
+        self.max_size = max_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._dispatching: set[asyncio.Task] = set()
+
+    async def submit(self, count: int, title: str, diagrams_text: str) -> str:
+        cached = llm_cache.get(combine_cache_key(count, title, diagrams_text))
+        if cached is not None:
+            logger.info("💾 LLM cache hit")
+            return strip_code_fences(cached)
+
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done() or self._worker.get_loop() is not loop:
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._collect())
+        future = loop.create_future()
+        await self._queue.put(((count, title, diagrams_text), future))
+        return await future
+
+    async def _collect(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            # Dispatch without waiting so the next window starts collecting now
+            task = loop.create_task(self._dispatch(batch))
+            self._dispatching.add(task)
+            task.add_done_callback(self._dispatching.discard)
+
+    async def _dispatch(self, batch: list) -> None:
+        try:
+            requests = [request for request, _ in batch]
+            if len(batch) == 1:
+                results = [await combine_with_llm(*requests[0])]
+            else:
+                logger.info(f"🔗 Batching {len(batch)} combine requests into one LLM call")
+                results = await self._combine_batch(requests)
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    async def _combine_batch(self, requests: list[tuple[int, str, str]]) -> list[str]:
+        sections = "\n".join(
+            COMBINE_BATCH_SECTION.format(index=i, count=count, title=title, diagrams=diagrams_text)
+            for i, (count, title, diagrams_text) in enumerate(requests, start=1)
+        )
+        # The concatenated prompt almost never repeats, so it is not cached itself
+        messages = COMBINE_BATCH_PROMPT.format_messages(requests=sections)
+        content = (await get_llm(COMBINE_TEMPERATURE).ainvoke(messages)).content
+
+        # re.split with one group yields [preamble, n1, body1, n2, body2, ...]
+        pieces = _RESULT_MARKER_RE.split(content)
+        answers = {int(n): strip_code_fences(body) for n, body in zip(pieces[1::2], pieces[2::2])}
+        if sorted(answers) == list(range(1, len(requests) + 1)) and all(answers.values()):
+            results = [answers[i] for i in range(1, len(requests) + 1)]
+            for request, result in zip(requests, results):
+                llm_cache.set(combine_cache_key(*request), result, expire=LLM_CACHE_TTL)
+            return results
+
+        logger.warning("Batched combine response could not be split; retrying requests individually.")
+        return list(await asyncio.gather(*(combine_with_llm(*request) for request in requests)))
+
+
+# Combine micro-batching (opt-in, useful when serving many HTTP clients)
+combine_batcher: Optional[CombineBatcher] = None
+if os.environ.get("COMBINE_BATCHING") == "1":
+    combine_batcher = CombineBatcher(
+        window=int(os.environ.get("COMBINE_BATCH_WINDOW_MS", "50")) / 1000,
+        max_size=int(os.environ.get("COMBINE_BATCH_MAX", "4")),
+    )
 
 
 # --- 4. The MCP Tools ---
 
 @mcp.tool()
-def process_research_page(ctx: PageContext) -> str:
+async def process_research_page(ctx: PageContext) -> str:
     """
     Main Entrypoint: Reads a Notion page, runs the AI agent to refine notes
     and generate a diagram, then updates the page with the results.
@@ -135,16 +706,13 @@ def process_research_page(ctx: PageContext) -> str:
     page_id = ctx.page_id
     logger.info(f"📖 Processing Page: {page_id}")
 
-    # A. Read Notion
+    # A. Read Notion (skipped entirely if the page is unchanged since last run)
     try:
-        blocks = notion.blocks.children.list(block_id=page_id)
+        cached = cached_page_result("process", page_id, await page_last_edited(page_id))
+        if cached is not None:
+            return cached
         # Extract text from paragraph blocks
-        raw_text_parts = []
-        for block in blocks["results"]:
-            if block["type"] == "paragraph" and block["paragraph"]["rich_text"]:
-                for text_item in block["paragraph"]["rich_text"]:
-                    raw_text_parts.append(text_item["plain_text"])
-        raw_text = "\n".join(raw_text_parts)
+        raw_text = await read_text(page_id, PARAGRAPH_TEXT_HANDLERS)
     except Exception as e:
         logger.error(f"Error reading Notion: {e}")
         return f"Error reading Notion: {e}"
@@ -154,65 +722,28 @@ def process_research_page(ctx: PageContext) -> str:
 
     logger.info(f"📝 Extracted {len(raw_text)} characters from page")
 
-    # B. Run Agent
+    # B. Run Agent: refiner and architect are independent, so both LLM calls
+    # run concurrently; nothing is written unless both succeed
     try:
-        state = AgentState(raw_notes=raw_text, page_id=page_id)
-        result = app.invoke(state)
+        refined_notes, mermaid_code = await asyncio.gather(
+            refine_notes(raw_text),
+            generate_diagram(raw_text),
+        )
     except Exception as e:
         logger.error(f"Error running agent: {e}")
         return f"Error running agent: {e}"
 
     # C. Write Back to Notion
     try:
-        # Add a divider first
-        notion.blocks.children.append(page_id, children=[{
-            "object": "block",
-            "type": "divider",
-            "divider": {}
-        }])
-        
-        # Add heading for refined notes
-        notion.blocks.children.append(page_id, children=[{
-            "object": "block",
-            "type": "heading_2",
-            "heading_2": {
-                "rich_text": [{"type": "text", "text": {"content": "✨ Refined Notes"}}]
-            }
-        }])
-        
-        # Append refined text (truncate if too long for Notion's limit)
-        refined_content = result["refined_notes"][:2000] if result.get("refined_notes") else ""
-        if refined_content:
-            notion.blocks.children.append(page_id, children=[{
-                "object": "block",
-                "type": "paragraph",
-                "paragraph": {
-                    "rich_text": [{"type": "text", "text": {"content": refined_content}}]
-                }
-            }])
-
-        # Add heading for diagram
-        notion.blocks.children.append(page_id, children=[{
-            "object": "block",
-            "type": "heading_2",
-            "heading_2": {
-                "rich_text": [{"type": "text", "text": {"content": "📊 Architecture Diagram"}}]
-            }
-        }])
-        
-        # Append Mermaid Diagram as a code block
-        mermaid_code = result.get("mermaid_code", "")
-        if mermaid_code:
-            notion.blocks.children.append(page_id, children=[{
-                "object": "block",
-                "type": "code",
-                "code": {
-                    "rich_text": [{"type": "text", "text": {"content": mermaid_code}}],
-                    "language": "mermaid"
-                }
-            }])
+        await append_blocks(page_id, refined_notes_blocks(refined_notes) + diagram_blocks(mermaid_code))
         
         logger.info("✅ Successfully updated Notion page!")
+        # Our own append bumped last_edited_time, so record the new value
+        try:
+            last_edited = await page_last_edited(page_id)
+            store_page_result("process", page_id, last_edited, "⏭️ Page unchanged since last run, skipped.")
+        except Exception as e:
+            logger.warning(f"Could not cache result for page {page_id}: {e}")
         return "✅ Page refined and diagram added!"
         
     except Exception as e:
@@ -221,7 +752,7 @@ def process_research_page(ctx: PageContext) -> str:
 
 
 @mcp.tool()
-def get_page_content(ctx: PageContext) -> str:
+async def get_page_content(ctx: PageContext) -> str:
     """
     Read and return the raw text content of a Notion page.
     Useful for inspecting what's on a page before processing.
@@ -236,29 +767,22 @@ def get_page_content(ctx: PageContext) -> str:
     logger.info(f"📖 Reading Page: {page_id}")
     
     try:
-        blocks = notion.blocks.children.list(block_id=page_id)
-        raw_text_parts = []
-        for block in blocks["results"]:
-            block_type = block["type"]
-            if block_type == "paragraph" and block[block_type]["rich_text"]:
-                for text_item in block[block_type]["rich_text"]:
-                    raw_text_parts.append(text_item["plain_text"])
-            elif block_type in ["heading_1", "heading_2", "heading_3"]:
-                if block[block_type]["rich_text"]:
-                    header_text = "".join([t["plain_text"] for t in block[block_type]["rich_text"]])
-                    raw_text_parts.append(f"\n{'#' * int(block_type[-1])} {header_text}\n")
-            elif block_type == "bulleted_list_item" and block[block_type]["rich_text"]:
-                for text_item in block[block_type]["rich_text"]:
-                    raw_text_parts.append(f"• {text_item['plain_text']}")
-                    
-        return "\n".join(raw_text_parts) if raw_text_parts else "⚠️ Page is empty."
+        last_edited = await page_last_edited(page_id)
+        cached = cached_page_result("content", page_id, last_edited)
+        if cached is not None:
+            return cached
+        content = await read_text(page_id)
+        if not content:
+            return "⚠️ Page is empty."
+        store_page_result("content", page_id, last_edited, content)
+        return content
     except Exception as e:
         logger.error(f"Error reading Notion: {e}")
         return f"Error reading Notion: {e}"
 
 
 @mcp.tool()
-def combine_architecture_diagrams(ctx: CombineDiagramsContext) -> str:
+async def combine_architecture_diagrams(ctx: CombineDiagramsContext) -> str:
     """
     Combine multiple Mermaid architecture diagrams into a single unified diagram.
     Uses AI to intelligently merge diagrams, identifying relationships between components.
@@ -277,38 +801,32 @@ def combine_architecture_diagrams(ctx: CombineDiagramsContext) -> str:
     if len(ctx.diagrams) == 1:
         return ctx.diagrams[0].mermaid_code
     
+    # Sort by label so re-submitted, reordered lists build the same prompt
+    # (and hit the exact-match cache)
+    diagrams = sorted(ctx.diagrams, key=lambda d: (d.label, d.mermaid_code))
+    
     # Build the prompt with all diagrams
     diagrams_text = "\n\n".join([
         f"### {d.label}\n```mermaid\n{d.mermaid_code}\n```"
-        for d in ctx.diagrams
+        for d in diagrams
     ])
     
-    prompt = f"""
-    You are an expert at creating Mermaid.js architecture diagrams.
-    
-    I have {len(ctx.diagrams)} separate architecture diagrams that I need you to combine 
-    into ONE unified system architecture diagram titled "{ctx.title}".
-    
-    Requirements:
-    1. Create a single cohesive graph TD diagram
-    2. Group each original diagram as a named subgraph
-    3. Identify logical connections BETWEEN the different systems
-    4. Use consistent styling and clear node names
-    5. Add a main title subgraph wrapping everything
-    6. Keep node labels concise but descriptive
-    7. Return ONLY the Mermaid code, no markdown blocks or explanations
-    
-    Here are the diagrams to combine:
-    
-    {diagrams_text}
-    
-    Generate the combined Mermaid diagram:
-    """
-    
     try:
-        response = llm.invoke(prompt)
-        # Clean up any markdown code blocks if present
-        code = response.content.replace("```mermaid", "").replace("```", "").strip()
+        embeddings = None
+        if semantic_cache:
+            embeddings = await semantic_cache.embed([f"{d.label}\n{d.mermaid_code}" for d in diagrams])
+            if embeddings is not None:
+                cached = semantic_cache.search(ctx.title, embeddings)
+                if cached is not None:
+                    logger.info("💾 Semantic cache hit for combined diagram")
+                    return cached
+
+        if combine_batcher:
+            code = await combine_batcher.submit(len(diagrams), ctx.title, diagrams_text)
+        else:
+            code = await combine_with_llm(len(diagrams), ctx.title, diagrams_text)
+        if embeddings is not None and code:
+            semantic_cache.add(ctx.title, embeddings, code)
         logger.info("✅ Successfully combined diagrams!")
         return code
     except Exception as e:
@@ -319,13 +837,20 @@ def combine_architecture_diagrams(ctx: CombineDiagramsContext) -> str:
 # --- 5. HTTP API Server (Alternative to MCP) ---
 def create_http_app():
     """Create a FastAPI app for direct HTTP access."""
+    from contextlib import asynccontextmanager
     from fastapi import FastAPI, HTTPException
     from fastapi.middleware.cors import CORSMiddleware
+
+    @asynccontextmanager
+    async def lifespan(_: FastAPI):
+        yield
+        await close_http_clients()
     
     http_app = FastAPI(
         title="Notion Research Buddy API",
         description="Direct HTTP API for processing Notion pages",
-        version="1.0.0"
+        version="1.0.0",
+        lifespan=lifespan
     )
     
     http_app.add_middleware(
@@ -336,48 +861,62 @@ def create_http_app():
         allow_headers=["*"],
     )
     
+    def page_context(page_id: str) -> PageContext:
+        try:
+            return PageContext(page_id=page_id)
+        except ValidationError as e:
+            raise HTTPException(status_code=400, detail=e.errors()[0]["msg"])
+    
     @http_app.get("/")
-    def root():
-        return {"status": "ok", "message": "Notion Research Buddy API is running!"}
+    async def root() -> StatusResponse:
+        return StatusResponse(status="ok", message="Notion Research Buddy API is running!")
     
     @http_app.get("/content/{page_id}")
-    def get_content(page_id: str):
+    async def get_content(page_id: str) -> PageContentResponse:
         """Get raw content from a Notion page."""
-        ctx = PageContext(page_id=page_id)
-        result = get_page_content(ctx)
+        ctx = page_context(page_id)
+        result = await get_page_content(ctx)
         if result.startswith("Error"):
             raise HTTPException(status_code=400, detail=result)
-        return {"page_id": page_id, "content": result}
+        return PageContentResponse(page_id=ctx.page_id, content=result)
     
     @http_app.post("/process/{page_id}")
-    def process_page(page_id: str):
+    async def process_page(page_id: str) -> ProcessResponse:
         """Process a Notion page: refine notes and generate diagram."""
-        ctx = PageContext(page_id=page_id)
-        result = process_research_page(ctx)
+        ctx = page_context(page_id)
+        result = await process_research_page(ctx)
         if result.startswith("Error"):
             raise HTTPException(status_code=400, detail=result)
-        return {"page_id": page_id, "result": result}
+        return ProcessResponse(page_id=ctx.page_id, result=result)
     
     @http_app.post("/combine-diagrams")
-    def combine_diagrams(request: CombineDiagramsContext):
+    async def combine_diagrams(request: CombineDiagramsContext) -> CombineResponse:
         """Combine multiple Mermaid diagrams into a unified architecture diagram."""
-        result = combine_architecture_diagrams(request)
+        result = await combine_architecture_diagrams(request)
         if result.startswith("Error"):
             raise HTTPException(status_code=400, detail=result)
-        return {"title": request.title, "combined_diagram": result}
+        return CombineResponse(title=request.title, combined_diagram=result)
     
     return http_app
 
 
+async def main() -> None:
+    """Run the selected server on one event loop shared by the async Notion/LLM clients."""
+    try:
+        if "--http" in sys.argv:
+            # Run as HTTP API server
+            import uvicorn
+            logger.info("🌐 Starting HTTP API Server on http://localhost:8000")
+            logger.info("📖 Docs available at http://localhost:8000/docs")
+            http_app = create_http_app()
+            await uvicorn.Server(uvicorn.Config(http_app, host="0.0.0.0", port=8000)).serve()
+        else:
+            # Run as MCP server (default)
+            logger.info("🚀 Starting Notion Research Buddy MCP Server...")
+            await mcp.run_async()
+    finally:
+        await close_http_clients()
+
+
 if __name__ == "__main__":
-    if "--http" in sys.argv:
-        # Run as HTTP API server
-        import uvicorn
-        logger.info("🌐 Starting HTTP API Server on http://localhost:8000")
-        logger.info("📖 Docs available at http://localhost:8000/docs")
-        http_app = create_http_app()
-        uvicorn.run(http_app, host="0.0.0.0", port=8000)
-    else:
-        # Run as MCP server (default)
-        logger.info("🚀 Starting Notion Research Buddy MCP Server...")
-        mcp.run()
+    asyncio.run(main())